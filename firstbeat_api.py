@@ -1,13 +1,18 @@
 import os
 import time
+import random
+import logging
+import threading
 import jwt
 from tqdm import tqdm
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from teamworks_api import upload_dataframe
+from teamworks_api import upload_dataframe, decode_json
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # =========================
 # ENV + AUTH SETUP + GLOBALS
@@ -25,9 +30,47 @@ SB_USERNAME = os.getenv("SB_USERNAME")
 SB_PASSWORD = os.getenv("SB_PASSWORD")
 SB_APP_ID   = os.getenv("SB_APP_ID", "firstbeat-sync")
 
+LOG_LEVEL = os.getenv("FIRSTBEAT_LOG_LEVEL", "INFO") # DEBUG also logs every request
+log = logging.getLogger("firstbeat")
+
 TEAM_ID = 20168 # all MALP and WALP on Firstbeat
 LAST_X_HOURS = 36 # looks back 6 hours but runs every hour, removes duplicates in R script
 USSS_COACH_ID = '3-4925' # U.S. Ski and Snowboard id
+MAX_WORKERS = int(os.getenv("FIRSTBEAT_MAX_WORKERS", 16)) # concurrent Firstbeat requests, the workload is network bound
+RESULTS_MAX_WORKERS = int(os.getenv("FIRSTBEAT_RESULTS_MAX_WORKERS", 8)) # results calls can kick off analysis (202), so keep these gentler on the API
+ANALYSIS_MAX_ROUNDS = 3 # re-polls of measurements still being analysed (202), waits ~5s, 10s, 20s
+ANALYSIS_PENDING = object() # get_measurement_results sentinel for a 202 response
+TRANSIENT_STATUSES = frozenset({429, 500, 502, 503, 504}) # retried by test_endpoint with backoff
+TRANSIENT_MAX_RETRIES = 8 # retries of connection errors, 429 and 5xx per request (on top of any 202 polling)
+
+# columns of the 'Firstbeat Summary Stats' upload, in order
+SESSION_COLUMNS = (
+    'start_date', 'start_time', 'end_date', 'end_time',
+    'First Name', 'Last Name', 'Date', 'Time', 'ID', 'Session Type', 'Duration',
+    'RMSSD', 'ACWR', 'HR Avg', 'HR Peak', 'TRIMP', 'Movement Load',
+    'Zone 1 (min)', 'Zone 2 (min)', 'Zone 3 (min)', 'Zone 4 (min)', 'Zone 5 (min)'
+)
+# Firstbeat result variable -> upload column, and the value used when a variable is missing
+VARIABLE_COLUMNS = {
+    'rmssd': 'RMSSD',
+    'acwr': 'ACWR',
+    'heartRateAverage': 'HR Avg',
+    'heartRatePeak': 'HR Peak',
+    'trimp': 'TRIMP',
+    'movementLoad': 'Movement Load',
+    'zone1Time': 'Zone 1 (min)',
+    'zone2Time': 'Zone 2 (min)',
+    'zone3Time': 'Zone 3 (min)',
+    'zone4Time': 'Zone 4 (min)',
+    'zone5Time': 'Zone 5 (min)'
+}
+# None (not "") for missing metrics so the column lists are built straight into float64 rather than object dtype
+VARIABLE_DEFAULTS = {col: (0 if col.startswith('Zone') else None) for col in VARIABLE_COLUMNS.values()}
+NUMERIC_COLUMNS = tuple(VARIABLE_COLUMNS.values())
+RESULT_VARS = ",".join(VARIABLE_COLUMNS) # only request the variables that are uploaded
+CATEGORY_COLUMNS = ('Session Type', 'First Name', 'Last Name') # low cardinality strings
+TIME_COLUMNS = ('start_date', 'start_time', 'end_date', 'end_time', 'Date', 'Time', 'Duration') # derived from the raw times
+RAW_TIME_COLUMNS = ('startTime', 'endTime') # ISO strings from the results response
 
 # IF missing correct infomration (probably in .env file, raise error)
 if not SB_USERNAME or not SB_PASSWORD:
@@ -36,22 +79,51 @@ if not SB_USERNAME or not SB_PASSWORD:
 if not CONSUMER_ID or not SHARED_SECRET or not API_KEY:
     raise RuntimeError("Missing ID, SHARED_SECRET, or API_KEY in .env")
 
-# GENERATE valid jwt key for header
+# shared session so every call reuses pooled keep-alive connections to api.firstbeat.com.
+# retries stay in test_endpoint rather than the adapter, so each attempt picks up a fresh jwt from auth_headers().
+# the id and results pools run at the same time, so size the pool for both or urllib3 discards connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_WORKERS + RESULTS_MAX_WORKERS,
+    max_retries=0
+))
+
+# GENERATE valid jwt key for header, cached until it is close to expiring
+JWT_TTL_SECONDS = 300 # lifetime of a signed token
+JWT_REFRESH_MARGIN = 30 # re-sign this many seconds before expiry so in-flight requests never carry a stale token
+_JWT_CACHE = {"token": None, "exp": 0}
+_JWT_LOCK = threading.Lock()
+
 def generate_jwt():
-    now = int(time.time())
-    payload = {"iss": CONSUMER_ID, "iat": now, "exp": now + 300}
-    token = jwt.encode(payload, SHARED_SECRET, algorithm="HS256")
-    if isinstance(token, bytes):
-        token = token.decode("utf-8")
-    return token
-
-# define headers for all api calls
+    with _JWT_LOCK:
+        if _JWT_CACHE["token"] and _JWT_CACHE["exp"] - time.time() > JWT_REFRESH_MARGIN:
+            return _JWT_CACHE["token"]
+
+        now = int(time.time())
+        payload = {"iss": CONSUMER_ID, "iat": now, "exp": now + JWT_TTL_SECONDS}
+        token = jwt.encode(payload, SHARED_SECRET, algorithm="HS256")
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+
+        _JWT_CACHE["token"] = token
+        _JWT_CACHE["exp"] = payload["exp"]
+        return token
+
+# define headers for all api calls, the dict is only rebuilt when the jwt is refreshed
+_HEADERS_CACHE = {"entry": (None, None)} # (token, headers), swapped as one tuple so threads never see a mismatch
+
 def auth_headers():
-    return {
-        "Authorization": f"Bearer {generate_jwt()}",
-        "x-api-key": API_KEY,
-        "Accept": "application/json"
-    }
+    token = generate_jwt()
+    cached_token, headers = _HEADERS_CACHE["entry"]
+    if cached_token != token:
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "x-api-key": API_KEY,
+            "Accept": "application/json"
+        }
+        _HEADERS_CACHE["entry"] = (token, headers)
+    return headers
 
 # GET time bounds (from x days back, to present moment)
 def last_x_hours_range(hours_back):
@@ -66,65 +138,58 @@ def last_x_hours_range(hours_back):
 # =========================
 # HELPER FOR API REQUESTS
 # =========================
-def _retry_after_seconds(response, fallback_seconds):
-    retry_after = response.headers.get("Retry-After")
-    if not retry_after:
-        return fallback_seconds
-    try:
-        return max(int(retry_after), 1)
-    except ValueError:
-        return fallback_seconds
+# wait before re-polling a 202: Firstbeat asks for 5s, doubled per retry and capped, plus up to 1s of jitter
+# so concurrent workers (and other clients) don't all come back in the same instant
+def analysis_wait_seconds(retry):
+    return min(5 * 2 ** retry, 40) + random.random()
 
 
-def test_endpoint(name, url, params=None, max_retries=5):
-    print(f"\n--- {name} ---")
-    #print("Authorization header (first 60):", headers["Authorization"][:60])
-    #print("x-api-key (first 8):", headers["x-api-key"][:8])
+# wait before retrying a connection error, 429 or 5xx: Retry-After when Firstbeat sends one,
+# otherwise exponential backoff capped at 30s, plus up to 1s of jitter
+def transient_wait_seconds(response, retry):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return min(max(float(retry_after), 0), 60)
+    except (TypeError, ValueError):
+        return min(2 ** (retry + 1), 30) + random.random()
 
-    last_exception = None
-    response = None
 
-    for attempt in range(1, max_retries + 1):
+def test_endpoint(name, url, params=None, max_retries=5):
+    log.debug("--- %s ---", name)
+
+    # max_retries bounds the polls while Firstbeat is still analysing the measurement (202),
+    # connection errors, 429 and 5xx get their own TRANSIENT_MAX_RETRIES budget.
+    # auth_headers() is called per attempt so a long backoff never resends an expired jwt
+    polls = 0
+    retries = 0
+    while True:
         try:
-            response = requests.get(url, headers=auth_headers(), params=params, timeout=60)
+            response = SESSION.get(url, headers=auth_headers(), params=params, timeout=60)
         except requests.RequestException as exc:
-            last_exception = exc
-            if attempt == max_retries:
+            if retries == TRANSIENT_MAX_RETRIES:
                 raise
-            wait_seconds = min(2 ** attempt, 30)
-            print(f"Request error ({exc}). Retrying in {wait_seconds}s...")
-            time.sleep(wait_seconds)
-            continue
-
-        if response.status_code == 202:
-            wait_seconds = 5
-            if attempt == max_retries:
-                return response
-            print(f"Analysis in progress, retrying in {wait_seconds}s...")
-            time.sleep(wait_seconds)
-            continue
-
-        if response.status_code == 429:
-            wait_seconds = _retry_after_seconds(response, fallback_seconds=min(2 ** attempt, 60))
-            if attempt == max_retries:
-                return response
-            print(f"Rate limited (429), retrying in {wait_seconds}s...")
+            wait_seconds = transient_wait_seconds(None, retries)
+            retries += 1
+            log.info("Request error (%s), retrying in %.1fs...", exc, wait_seconds)
             time.sleep(wait_seconds)
             continue
 
-        if response.status_code >= 500:
-            wait_seconds = min(2 ** attempt, 30)
-            if attempt == max_retries:
+        if response.status_code in TRANSIENT_STATUSES:
+            if retries == TRANSIENT_MAX_RETRIES:
                 return response
-            print(f"Server error ({response.status_code}), retrying in {wait_seconds}s...")
+            wait_seconds = transient_wait_seconds(response, retries)
+            retries += 1
+            log.info("%s returned %s, retrying in %.1fs...", name, response.status_code, wait_seconds)
             time.sleep(wait_seconds)
             continue
 
-        return response
+        polls += 1
+        if response.status_code != 202 or polls == max_retries:
+            return response
 
-    if response is not None:
-        return response
-    raise last_exception
+        wait_seconds = analysis_wait_seconds(polls - 1)
+        log.info("Analysis in progress, retrying in %.1fs...", wait_seconds)
+        time.sleep(wait_seconds)
 
 def get_measurement_ids(athlete_id, from_time, to_time, name=''):
     measurement = test_endpoint( 
@@ -136,16 +201,13 @@ def get_measurement_ids(athlete_id, from_time, to_time, name=''):
 
     try:
         measurement.raise_for_status()
+        measurements = decode_json(measurement).get("measurements", [])
     except requests.RequestException as exc:
-        print(f"WARNING: Failed to fetch measurements for {name} ({athlete_id}): {exc}")
+        log.warning("Failed to fetch measurements for %s (%s): %s", name, athlete_id, exc)
         return []
 
     # Get ids of measurements to pull results
-    measurement_ids = [
-        m["measurementId"]
-        for m in measurement.json().get("measurements", [])
-        if "measurementId" in m
-    ]
+    measurement_ids = [m["measurementId"] for m in measurements if "measurementId" in m]
 
     #if len(measurement_ids) > 0:
         #print(f'\n-- Found {len(measurement_ids)} measurement for {name} --')
@@ -158,108 +220,158 @@ def get_measurement_results(athlete_id, measurement_id):
         f"{BASE_URL}/sports/accounts/{USSS_COACH_ID}/athletes/{athlete_id}/measurements/{measurement_id}/results",
         params={
             "format": "list",
-            "var": "rmssd,acwr,heartRateAverage,heartRatePeak,heartRateAveragePercentage,zone1Time,zone2Time,zone3Time,zone4Time,zone5Time,trimp,quickRecoveryTestScore,movementLoad"
+            "var": RESULT_VARS
         },
-        max_retries=8
+        max_retries=1 # a 202 is handed back to get_all_measurements, which retries it in a later round
     )
 
+    if resp.status_code == 202:
+        return ANALYSIS_PENDING
     resp.raise_for_status()
-    return resp.json()
+    return decode_json(resp)
+
+# fetch measurement ids for every athlete concurrently and queue each results fetch as soon as that
+# athlete's ids arrive, so the two phases overlap. Returns [((athlete_id, measurement_id), results), ...]
+# in athlete order, failed results fetches come back as None.
+# Measurements Firstbeat is still analysing (202) are retried together in rounds with a growing wait,
+# instead of each one holding a worker while it sleeps
+def get_all_measurements(athletes, athlete_names, from_time, to_time):
+    def fetch_ids(athlete_id):
+        return get_measurement_ids(athlete_id, from_time, to_time, name=athlete_names[athlete_id])
+
+    def fetch_results(athlete_id, measurement_id):
+        try:
+            return get_measurement_results(athlete_id, measurement_id)
+        except requests.RequestException as exc:
+            log.warning("Skipping measurement %s-%s after retries: %s", measurement_id, athlete_id, exc)
+            return None
+
+    queued = {} # athlete index -> [(pair, results future), ...]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ids_executor, \
+            ThreadPoolExecutor(max_workers=RESULTS_MAX_WORKERS) as results_executor:
+        id_futures = {
+            ids_executor.submit(fetch_ids, athlete['athleteId']): (index, athlete['athleteId'])
+            for index, athlete in enumerate(athletes)
+        }
+        progress = tqdm(
+            as_completed(id_futures), "Fetching Athlete Sessions", total=len(athletes),
+            miniters=max(1, len(athletes) // 20), mininterval=0.5 # ~20 redraws total, keeps cron logs small
+        )
+        for future in progress:
+            index, athlete_id = id_futures[future]
+            queued[index] = [
+                ((athlete_id, measurement_id), results_executor.submit(fetch_results, athlete_id, measurement_id))
+                for measurement_id in future.result()
+            ]
+
+        print(f'--- Waiting on Results for {sum(len(q) for q in queued.values())} Measurements ---')
+        results = {pair: future.result() for index in sorted(queued) for pair, future in queued[index]}
+
+        for analysis_round in range(ANALYSIS_MAX_ROUNDS):
+            pending = [pair for pair, resp in results.items() if resp is ANALYSIS_PENDING]
+            if not pending:
+                break
+            wait_seconds = analysis_wait_seconds(analysis_round)
+            log.info("Analysis in progress for %d measurements, retrying in %.1fs...", len(pending), wait_seconds)
+            time.sleep(wait_seconds)
+            for pair, resp in zip(pending, results_executor.map(lambda pair: fetch_results(*pair), pending)):
+                results[pair] = resp
+
+    for (athlete_id, measurement_id), resp in results.items():
+        if resp is ANALYSIS_PENDING:
+            log.warning("Skipping measurement %s-%s, analysis still in progress", measurement_id, athlete_id)
+            results[(athlete_id, measurement_id)] = None
+    return list(results.items())
+
+# append one Smartabase row from a measurement results response onto the column lists
+# (times are kept as raw ISO strings here and formatted for the whole column in add_session_times)
+def append_session(cols, athlete, measurement_id, resp, first_last):
+    first_name, last_name = first_last[athlete]
+
+    # single pass over the response variables, only the ones we upload are kept
+    values = dict(VARIABLE_DEFAULTS)
+    for v in resp.get("variables", ()):
+        col = VARIABLE_COLUMNS.get(v.get("name"))
+        if col is not None:
+            values[col] = v.get("value")
+
+    cols['startTime'].append(resp['startTime'])
+    cols['endTime'].append(resp['endTime'])
+    cols['First Name'].append(first_name)
+    cols['Last Name'].append(last_name)
+    cols['ID'].append(f'{measurement_id}-{athlete}')
+    cols['Session Type'].append(resp['measurementType'])
+    for col, value in values.items():
+        cols[col].append(value)
+
+# parse the raw ISO times once per column and derive the Smartabase date/time and duration columns (UTC)
+def add_session_times(df):
+    start = pd.to_datetime(df.pop('startTime'), utc=True, format='ISO8601')
+    end = pd.to_datetime(df.pop('endTime'), utc=True, format='ISO8601')
+    end_date = end.dt.strftime("%d/%m/%Y")
+    end_time = end.dt.strftime("%I:%M %p").str.lstrip("0")
+
+    df['start_date'] = start.dt.strftime("%d/%m/%Y")
+    df['start_time'] = start.dt.strftime("%I:%M %p").str.lstrip("0")
+    df['end_date'] = end_date
+    df['end_time'] = end_time
+    df['Date'] = end_date
+    df['Time'] = end_time
+    df['Duration'] = ((end - start).dt.total_seconds() / 60).round(2) # minutes
+    return df[list(SESSION_COLUMNS)]
 
 # =========================
-# STEP 3 — ATHLETES
+# FIRSTBEAT PIPELINE
 # =========================
-athletes_resp = test_endpoint(
-    "Athlete List",
-    f"{BASE_URL}/sports/accounts/{USSS_COACH_ID}/teams/{TEAM_ID}/athletes"
-)
-athletes = athletes_resp.json().get("athletes", [])
-athlete_names = {}
-for athlete in athletes:
-    athlete_names[athlete['athleteId']] = f"{athlete['firstName']} {athlete['lastName']}"
-print(f"Found {len(athletes)} athletes")
+def fetch_firstbeat(hours_back):
+    """
+    Pulls every team athlete's measurements that started in the last `hours_back` hours
+    and returns them as a DataFrame with the SESSION_COLUMNS of the upload form.
+    """
+    # STEP 3 — ATHLETES
+    athletes_resp = test_endpoint(
+        "Athlete List",
+        f"{BASE_URL}/sports/accounts/{USSS_COACH_ID}/teams/{TEAM_ID}/athletes"
+    )
+    athletes = decode_json(athletes_resp).get("athletes", [])
+    athlete_names = {}
+    first_last = {} # (first, last) straight from the API, so multi-word first or last names stay intact
+    for athlete in athletes:
+        first_last[athlete['athleteId']] = (athlete['firstName'].strip(), athlete['lastName'].strip())
+        athlete_names[athlete['athleteId']] = " ".join(first_last[athlete['athleteId']])
+    print(f"Found {len(athletes)} athletes")
+
+    # STEP 4 — GET ATHLETE MEASUREMENTS (think of as a session)
+    from_time, to_time = last_x_hours_range(hours_back)
+    measurements = get_all_measurements(athletes, athlete_names, from_time, to_time)
+
+    cols = {col: [] for col in RAW_TIME_COLUMNS + SESSION_COLUMNS if col not in TIME_COLUMNS}
+    for (athlete, measurement_id), resp in measurements:
+        if resp is not None:
+            append_session(cols, athlete, measurement_id, resp, first_last)
+
+    df = add_session_times(pd.DataFrame(cols))
+    for col in NUMERIC_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype('category')
+    return df
 
 # =========================
-# STEP 4 — GET ATHLETE MEASUREMENTS (think of as a session)
+# STEP 5 — UPLOAD
 # =========================
+def main():
+    logging.basicConfig(level=LOG_LEVEL, format="%(levelname)s: %(message)s")
+    df = fetch_firstbeat(LAST_X_HOURS)
 
-# get measurementIds for athelte sessions in last x days
-from_time, to_time = last_x_hours_range(LAST_X_HOURS) # get time intervals for last day
-measurements = {}
-for athlete in tqdm(athletes, "Fetching Athlete Sessions"):
-    athlete_id = athlete['athleteId']
-    name = athlete_names[athlete_id]
-
-    # Pull athlete 'measurements'
-    measurement_ids = get_measurement_ids(athlete_id, from_time, to_time, name=name)
-    if measurement_ids != []:
-        measurements[athlete_id] = measurement_ids
-
-# get results of the measuremnts 
-rmssd = []
-athlete_w_measurements = list(measurements.keys())
-for athlete in athlete_w_measurements:
-    print(f'--- Getting Measurements for {athlete_names[athlete]} ---')
-    for measurement_id in measurements[athlete]:
-        try:
-            resp = get_measurement_results(athlete, measurement_id)
-        except requests.RequestException as exc:
-            print(f"WARNING: Skipping measurement {measurement_id}-{athlete} after retries: {exc}")
-            continue
-
-        resp['endTime'] = datetime.fromisoformat(resp['endTime'].replace("Z", ""))
-        resp['startTime'] = datetime.fromisoformat(resp['startTime'].replace("Z", ""))
-
-        # get variables
-        variables = {
-            v.get("name"): v.get("value")
-            for v in resp.get("variables", [])
-        }
-        
-        rmssd_value = variables.get("rmssd", "")
-        acwr_value = variables.get("acwr", "")
-        hr_avg = variables.get("heartRateAverage", "")
-        hr_peak = variables.get("heartRatePeak", "")
-        trimp = variables.get("trimp", "")
-        movement_load = variables.get("movementLoad", "")
-        zone1 = variables.get("zone1Time", 0)
-        zone2 = variables.get("zone2Time", 0)
-        zone3 = variables.get("zone3Time", 0)
-        zone4 = variables.get("zone4Time", 0)
-        zone5 = variables.get("zone5Time", 0)
-        
-        session = {
-            'start_date': resp['startTime'].strftime("%d/%m/%Y"),
-            'start_time': resp['startTime'].strftime("%I:%M %p").lstrip("0"),
-            'end_date': resp['endTime'].strftime("%d/%m/%Y"),
-            'end_time': resp['endTime'].strftime("%I:%M %p").lstrip("0"),
-            'First Name': athlete_names[athlete].split()[0],
-            'Last Name': athlete_names[athlete].split()[1],
-            'Date': resp['endTime'].strftime("%d/%m/%Y"),
-            'Time': resp['endTime'].strftime("%I:%M %p").lstrip("0"),
-            'ID': f'{measurement_id}-{athlete}',
-            'Session Type': resp['measurementType'],
-            'RMSSD': rmssd_value,
-            'ACWR': acwr_value,
-            'HR Avg': hr_avg,
-            'HR Peak': hr_peak,
-            'TRIMP': trimp,
-            'Movement Load': movement_load,
-            'Zone 1 (min)': zone1,
-            'Zone 2 (min)': zone2,
-            'Zone 3 (min)': zone3,
-            'Zone 4 (min)': zone4,
-            'Zone 5 (min)': zone5
-        }
-        rmssd.append(session)
+    if df.empty:
+        print("WARNING: No measurement data found, no upload.")
+    else:
+        print("Uploading Firstbeat data to Smartabase... using the teamworks_api module.\n")
+        upload_dataframe(df, "Firstbeat Summary Stats", SB_USERNAME, SB_PASSWORD, SB_BASE_URL, SB_APP_ID, verbose=True)
 
-df = pd.DataFrame(rmssd)
+    print("\n=== DONE WITH FIRSTBEAT API===\n")
 
-if len(rmssd) == 0:
-    print("WARNING: No measurement data found, no upload.")
-else:
-    df = pd.DataFrame(rmssd)
-    print("Uploading Firstbeat data to Smartabase... using the teamworks_api module.\n")
-    upload_dataframe(df, "Firstbeat Summary Stats", SB_USERNAME, SB_PASSWORD, SB_BASE_URL, SB_APP_ID, verbose=True)
 
-print("\n=== DONE WITH FIRSTBEAT API===\n")
+if __name__ == "__main__":
+    main()
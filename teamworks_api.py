@@ -1,6 +1,16 @@
 import requests
+import orjson
 import pandas as pd
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import functools
+import hashlib
+import logging
+import os
+import random
+import tempfile
+import threading
 import time
 
 '''
@@ -17,7 +27,11 @@ Required Args for the data_upload function:
     sb_password: str - Smartabase password
     sb_url: str - Base URL of the Smartabase instance
     sb_app_id: str - Application ID for Smartabase API access
-    verbose: bool - Whether to print progress messages
+    verbose: bool - Whether to print summary messages, and log the per-row "Uploaded Measurement" lines at INFO
+             (they go to the teamworks_api logger, so logging must be configured to see them)
+    max_workers: int - How many event batches to POST concurrently (optional, defaults to UPLOAD_MAX_WORKERS)
+    batch_size: int - How many events to send per eventimport call (optional, defaults to UPLOAD_BATCH_SIZE)
+    pair_keys: list[str] - Form columns to send as key/value pairs (optional, defaults to EVENT_PAIR_KEYS)
 
  Required Columns in DataFrame:
     "First Name" - First name of the user
@@ -26,59 +40,122 @@ Required Args for the data_upload function:
          - this is different from the event-ID and allows for deduplication and merging
          - this should be either pulled from the api or created in a unique and replicable way
 '''
+log = logging.getLogger(__name__)
+
+UPLOAD_MAX_WORKERS = 16 # concurrent eventimport POSTs, each one is a separate Smartabase round trip
+UPLOAD_BATCH_SIZE = 100 # events per eventimport call
+SYNC_MAX_WORKERS = 8 # user batches synced concurrently during dedupe, each one paginates its own cursor
+SYNC_FALLBACK_MAX_WORKERS = 4 # halves of 5xx'd user batches synced concurrently, shared by every split in one dedupe call
+USER_MAP_CACHE_TTL = 6 * 60 * 60 # seconds a cached (first, last) -> user_id map stays valid
+SYNC_STATE_TTL = float(os.getenv("SB_FULL_RESYNC_HOURS", 24)) * 60 * 60 # seconds before dedupe state is dropped and a full resync is forced
+SB_POOL_MAXSIZE = max(UPLOAD_MAX_WORKERS, SYNC_MAX_WORKERS + SYNC_FALLBACK_MAX_WORKERS) # pooled connections per account by default
+SB_CACHE_DIR = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "smartabase")
+
 # =========================
 # EVENT PAYLOAD - TODO: customize per form
 # =========================
 
-def _build_event_payload(row, form_name):
-    ''' fucntion to build the event payload for a single row of data, this is an EXAMPLE and should be customized per form '''
-    pair_keys = [
-        "ID",
-        "Duration",
-        "Session Type",
-        "ACWR",
-        "RMSSD",
-        "HR Avg",
-        "HR Peak",
-        "TRIMP",
-        "Movement Load",
-        "Zone 1 (min)",
-        "Zone 2 (min)",
-        "Zone 3 (min)",
-        "Zone 4 (min)",
-        "Zone 5 (min)"
-    ]
-    
-    pairs = [
-        {"key": key, "value": str(row.get(key, ""))}
-        for key in pair_keys
+def _format_value(value):
+    ''' stringify a cell for Smartabase: missing values become "" and whole floats drop the trailing .0 '''
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+EVENT_PAIR_KEYS = (
+    "ID",
+    "Duration",
+    "Session Type",
+    "ACWR",
+    "RMSSD",
+    "HR Avg",
+    "HR Peak",
+    "TRIMP",
+    "Movement Load",
+    "Zone 1 (min)",
+    "Zone 2 (min)",
+    "Zone 3 (min)",
+    "Zone 4 (min)",
+    "Zone 5 (min)"
+) # default form columns sent as key/value pairs, pass pair_keys to upload_dataframe for other forms
+
+
+def _build_event_payloads(df, form_name, pair_keys=EVENT_PAIR_KEYS):
+    ''' fucntion to build the event payloads for every row of data, this is an EXAMPLE and should be customized per form
+        payloads are built column-wise: each column is pulled out once and the rows are zipped together in one pass '''
+    # defaults are computed once, not per row
+    today = pd.Timestamp.now().strftime("%d/%m/%Y")
+    n_rows = len(df)
+
+    def column(name, default):
+        return df[name].tolist() if name in df.columns else [default] * n_rows
+
+    pair_values = zip(*[[_format_value(value) for value in column(key, "")] for key in pair_keys])
+
+    return [
+        {
+            "formName": form_name,
+            "startDate": start_date,
+            "startTime": start_time,
+            "finishDate": end_date,
+            "finishTime": end_time,
+            "userId": {"userId": int(user_id)},
+            "rows": [
+                {
+                    "row": 0,
+                    "pairs": [{"key": key, "value": value} for key, value in zip(pair_keys, values)]
+                }
+            ]
+        }
+        for start_date, start_time, end_date, end_time, user_id, values in zip(
+            column("start_date", today),
+            column("start_time", ""),
+            column("end_date", today),
+            column("end_time", ""),
+            df["user_id"].tolist(),
+            pair_values
+        )
     ]
-    
-    return {
-        "formName": form_name,
-        "startDate": row.get("start_date", pd.Timestamp.now().strftime("%d/%m/%Y")),
-        "startTime": row.get("start_time", ""),
-        "finishDate": row.get("end_date", pd.Timestamp.now().strftime("%d/%m/%Y")),
-        "finishTime": row.get("end_time", ""),
-        "userId": {"userId": int(row["user_id"])},
-        "rows": [
-            {
-                "row": 0,
-                "pairs": pairs
-            }
-        ]
-    }
+
+
+def _build_batch_payload(payloads):
+    ''' wrap several event payloads into one eventimport body '''
+    return {"events": payloads}
+
+
+def _event_import_results(response, n_events):
+    ''' per-event success flags from a 200 eventimport response.
+        Uses the "ids" list (one entry per event, in order, empty where that event wasn't imported) when it lines up
+        with the events sent, otherwise the overall "state". An unreadable body counts as failed, not re-sent. '''
+    try:
+        body = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return [False] * n_events
+    if not isinstance(body, dict):
+        return [False] * n_events
+
+    ids = body.get("ids")
+    if isinstance(ids, list) and len(ids) == n_events:
+        return [bool(event_id) for event_id in ids]
+    return [body.get("state") == "SUCCESSFULLY_IMPORTED"] * n_events
 
 
 # =========================
 # PUBLIC ENTRY POINT - MAIN MEHTHOD
 # =========================
 
-def upload_dataframe(df: pd.DataFrame, form_name, sb_username, sb_password, sb_url, sb_app_id, verbose: bool = True) -> int:
+def upload_dataframe(df: pd.DataFrame, form_name, sb_username, sb_password, sb_url, sb_app_id, verbose: bool = True,
+                     max_workers: int = UPLOAD_MAX_WORKERS, batch_size: int = UPLOAD_BATCH_SIZE,
+                     pair_keys=EVENT_PAIR_KEYS) -> int:
     """
     Uploads form name data into Smartabase.
     NOTE: DataFrame must contain the correct that match the form in and must have columns:
         "First Name", "Last Name", "ID" where ID is a unique identifier for the measurement/event that allows for deduplication.
+    Events are sent batch_size at a time in one eventimport call, max_workers batches at once.
+    pair_keys are the form columns sent for each event (columns missing from df are sent as "").
+    Per-row results are logged to the "teamworks_api" logger (INFO when verbose, DEBUG otherwise),
+    call logging.basicConfig() or attach a handler to see them.
     """
 
     # check that required rows are in here
@@ -95,17 +172,20 @@ def upload_dataframe(df: pd.DataFrame, form_name, sb_username, sb_password, sb_u
     # -------------------------
     # Map users
     # -------------------------
-    user_map = get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id)
+    user_map, from_cache = _get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id)
 
-    df = df.copy()
-    df["user_id"] = df.apply(
-        lambda r: user_map.get((r["First Name"], r["Last Name"])),
-        axis=1
-    )
+    # one hash lookup per (first, last) pair inside pandas, no per-row apply callback
+    keys = pd.MultiIndex.from_arrays([df["First Name"], df["Last Name"]])
+    user_ids = keys.map(user_map).to_numpy()
+    matched = pd.notna(user_ids)
 
-    df = df[df["user_id"].notna()]
+    # a cached map misses athletes added in Smartabase since it was fetched, so refetch once before giving up on them
+    if from_cache and not matched.all():
+        user_map = get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id, force_refresh=True)
+        user_ids = keys.map(user_map).to_numpy()
+        matched = pd.notna(user_ids)
 
-    if df.empty:
+    if not matched.any():
         if verbose:
             print("No rows matched Smartabase users. Nothing to upload.")
         return 0
@@ -113,8 +193,14 @@ def upload_dataframe(df: pd.DataFrame, form_name, sb_username, sb_password, sb_u
     # -------------------------
     # Remove duplicates
     # -------------------------
-    existing_ids = get_existing_measurement_ids(df["user_id"].tolist(), form_name, sb_username, sb_password, sb_app_id, sb_url)
-    df = df[~df["ID"].isin(existing_ids)]
+    matched_user_ids = pd.Series(user_ids[matched]).astype("int64")
+    pending_ids_by_user = df["ID"][matched].groupby(matched_user_ids.to_numpy()).agg(set).to_dict()
+    existing_ids = get_existing_measurement_ids(matched_user_ids, form_name, sb_username, sb_password, sb_app_id, sb_url,
+                                                pending_ids_by_user=pending_ids_by_user)
+
+    # one combined mask, so the frame is sliced (and copied) once instead of after every filter
+    mask = matched & ~df["ID"].isin(existing_ids).to_numpy()
+    df = df.loc[mask].assign(user_id=user_ids[mask])
 
     if df.empty:
         if verbose:
@@ -127,24 +213,53 @@ def upload_dataframe(df: pd.DataFrame, form_name, sb_username, sb_password, sb_u
     url = f"{sb_url}/api/v1/eventimport?informat=json&format=json"
 
     success_count = 0
+    session = _sb_session(sb_username, sb_password, sb_app_id, max_workers)
 
-    for _, row in df.iterrows():
-        payload = _build_event_payload(row, form_name)
+    # rows and their payloads are built up front, only the POSTs run on the workers
+    records = df[required_columns].to_dict(orient="records")
+    payloads = _build_event_payloads(df, form_name, pair_keys)
 
-        r = requests.post(
-            url,
-            headers=_sb_headers(sb_app_id),
-            auth=_sb_auth(sb_username, sb_password),
-            json=payload,
-            timeout=30
-        )
+    def post(body):
+        return session.post(url, data=body, timeout=60)
 
+    def upload_single(row, payload):
+        try:
+            r = post(orjson.dumps(payload))
+        except requests.RequestException as exc:
+            return row, False, str(exc)
+        ok = r.status_code == 200 and _event_import_results(r, 1)[0]
+        return row, ok, f"{r.status_code} - {r.text}"
+
+    def upload_batch(batch):
+        rows = [row for row, _ in batch]
+        try:
+            r = post(orjson.dumps(_build_batch_payload([payload for _, payload in batch])))
+        except requests.RequestException as exc:
+            # timed out or dropped mid-request: part of the batch may already be imported and eventimport
+            # isn't idempotent, so these rows are reported as failed rather than re-sent
+            return [(row, False, str(exc)) for row in rows]
+
+        detail = f"{r.status_code} - {r.text}"
         if r.status_code == 200:
-            success_count += 1
-            if verbose:
-                print(f"Uploaded Measurement: {row['First Name']} {row['Last Name']} (Session ID: {row['ID']})")
-        else:
-            print(f"FAILED ({row['ID']}): {r.status_code} - {r.text}")
+            return [(row, ok, detail) for row, ok in zip(rows, _event_import_results(r, len(rows)))]
+        if 400 <= r.status_code < 500 and r.status_code != 429:
+            # batch format rejected, nothing was imported: one POST per event so a single bad row doesn't sink the rest
+            return [upload_single(row, payload) for row, payload in batch]
+        # 429/5xx: the server may have imported part of the batch, re-sending would duplicate those events
+        return [(row, False, detail) for row in rows]
+
+    row_level = logging.INFO if verbose else logging.DEBUG
+
+    # batches run concurrently, results come back in row order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for results in executor.map(upload_batch, _chunk_list(list(zip(records, payloads)), batch_size)):
+            # per-row lines go to the logger: INFO when verbose, DEBUG otherwise
+            for row, ok, detail in results:
+                if ok:
+                    success_count += 1
+                    log.log(row_level, "Uploaded Measurement: %s %s (Session ID: %s)", row["First Name"], row["Last Name"], row["ID"])
+                else:
+                    log.warning("FAILED (%s): %s", row["ID"], detail)
 
     if verbose:
         print(f"Successfully uploaded {success_count} {form_name} events.")
@@ -165,43 +280,159 @@ def _sb_headers(sb_app_id):
 def _sb_auth(sb_username, sb_password):
     return HTTPBasicAuth(sb_username, sb_password)
 
+def _sb_session(sb_username, sb_password, sb_app_id, pool_maxsize=SB_POOL_MAXSIZE):
+    ''' one pooled session per Smartabase account, so every call reuses keep-alive connections
+        and the headers/auth are attached once instead of passed on every request.
+        pool_maxsize is the most concurrent requests the caller will make, a pool smaller than that makes urllib3
+        discard connections, so callers asking for more than SB_POOL_MAXSIZE get their own bigger session '''
+    return _pooled_sb_session(sb_username, sb_password, sb_app_id, max(pool_maxsize, SB_POOL_MAXSIZE))
+
+
+@functools.lru_cache(maxsize=None)
+def _pooled_sb_session(sb_username, sb_password, sb_app_id, pool_maxsize):
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=0))
+    session.headers.update(_sb_headers(sb_app_id))
+    session.auth = _sb_auth(sb_username, sb_password)
+    return session
+
+
+def decode_json(response):
+    ''' orjson.loads, but a non-JSON body (e.g. an HTML login page with a 200) raises requests.JSONDecodeError
+        like r.json() did, so it lands in the callers' RequestException handlers '''
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as exc:
+        raise requests.exceptions.JSONDecodeError(exc.msg, exc.doc, exc.pos, response=response) from exc
+
+
+def _with_cursor(body, cursor):
+    ''' splice a pagination cursor into an already-encoded JSON object, so the static part of the request is encoded once '''
+    if not cursor:
+        return body
+    return body[:-1] + b',"cursor":' + orjson.dumps(cursor) + b'}'
+
 
 def _chunk_list(values, chunk_size):
     for i in range(0, len(values), chunk_size):
         yield values[i:i + chunk_size]
 
 
-def _post_with_retries(url, headers, auth, payload, timeout=60, max_attempts=3):
+class CircuitOpenError(requests.RequestException):
+    ''' raised instead of calling Smartabase while the circuit breaker is open '''
+
+
+class CircuitBreaker:
     """
-    Retries transient request failures (network/5xx) with exponential backoff.
+    Process-wide breaker for Smartabase calls.
+    Opens after failure_threshold consecutive failures, refuses calls for cooldown seconds,
+    then lets a single probe through (HALF_OPEN) to decide whether to close again.
     """
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "CLOSED"
+        self.failure_count = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "CLOSED":
+                return True
+            if self.state == "OPEN" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "HALF_OPEN"
+                return True
+            # still cooling down, or the half-open probe is already in flight
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "CLOSED"
+            self.failure_count = 0
+
+    def record_failure(self, probe_only=False):
+        ''' probe_only=True counts the failure only if it settles a half-open probe, which must end in a success or a failure '''
+        with self._lock:
+            if probe_only and self.state != "HALF_OPEN":
+                return
+            self.failure_count += 1
+            if self.state == "HALF_OPEN" or self.failure_count >= self.failure_threshold:
+                self.state = "OPEN"
+                self.opened_at = time.monotonic()
+
+
+_SB_BREAKER = CircuitBreaker()
+
+
+def _backoff_seconds(attempt, base=0.5, cap=30.0):
+    ''' full jitter: anywhere between 0 and the capped exponential step, so concurrent workers don't retry in lockstep '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _retry_after_seconds(response):
+    ''' seconds from a numeric Retry-After header, or None if it is missing/not a number '''
+    value = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _post_with_retries(session, url, payload, timeout=60, max_attempts=3, budget_seconds=120, record_server_errors=True,
+                       retry_server_errors=True):
+    """
+    Retries transient request failures (network/429/5xx) with full-jitter exponential backoff.
+    Retries stop early once budget_seconds have passed, and every call goes through the shared circuit breaker.
+    record_server_errors=False keeps 5xx responses off the breaker, for callers that handle them by shrinking the request,
+    unless that request was the half-open probe, which always counts so the breaker can't get stuck half-open.
+    retry_server_errors=False raises a 5xx straight away instead of retrying it at the same size,
+    network errors, timeouts and 429 are still retried.
+    payload can be a dict or already-encoded JSON bytes; either way it is encoded once, not per attempt.
+    """
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
     last_error = None
+    deadline = time.monotonic() + budget_seconds
 
     for attempt in range(1, max_attempts + 1):
+        if not _SB_BREAKER.allow():
+            raise CircuitOpenError(f"Smartabase circuit breaker is open, skipping request to {url}")
+
+        delay = None
         try:
-            response = requests.post(
+            response = session.post(
                 url,
-                headers=headers,
-                auth=auth,
-                json=payload,
+                data=body,
                 timeout=timeout
             )
             response.raise_for_status()
+            _SB_BREAKER.record_success()
             return response
         except requests.HTTPError as exc:
             status = exc.response.status_code if exc.response is not None else None
             last_error = exc
 
             # Non-server errors should fail fast (bad auth, bad request, etc).
-            if status is not None and status < 500:
+            if status is not None and status < 500 and status != 429:
+                _SB_BREAKER.record_success()
                 raise
 
-            if attempt < max_attempts:
-                time.sleep(2 ** (attempt - 1))
+            _SB_BREAKER.record_failure(probe_only=not (record_server_errors or status == 429))
+            if status != 429 and not retry_server_errors:
+                raise
+            if status == 429:
+                delay = _retry_after_seconds(exc.response)
         except requests.RequestException as exc:
             last_error = exc
-            if attempt < max_attempts:
-                time.sleep(2 ** (attempt - 1))
+            _SB_BREAKER.record_failure()
+
+        if attempt < max_attempts:
+            if delay is None:
+                delay = _backoff_seconds(attempt)
+            if time.monotonic() + delay > deadline:
+                break
+            time.sleep(delay)
 
     raise last_error
 
@@ -209,13 +440,91 @@ def _post_with_retries(url, headers, auth, payload, timeout=60, max_attempts=3):
 # USERS (CORRECT ENDPOINT)
 # =========================
 
-def get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id):
+_USER_MAP_CACHE = {}
+_USER_MAP_LOCK = threading.Lock()
+
+
+def _cache_path(prefix, *parts):
+    ''' on-disk cache file for one Smartabase account, hashed so the url/username never show up in the filename '''
+    digest = hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()[:16]
+    return os.path.join(SB_CACHE_DIR, f"{prefix}_{digest}.json")
+
+
+def _read_cache(path, ttl):
+    ''' decode the JSON in path if it is younger than ttl seconds, otherwise None.
+        JSON rather than pickle, so a tampered cache file (e.g. one restored from CI) can't run code '''
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, orjson.JSONDecodeError) as exc:
+        # a truncated or corrupt file is just a cache miss
+        log.warning("Ignoring unreadable Smartabase cache %s: %s", path, exc)
+        return None
+
+
+def _write_cache(path, value):
+    ''' write JSON to a temp file and os.replace it in, so a reader never sees a half-written cache '''
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(value))
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        # the cache is only an optimisation, a read-only or full disk shouldn't stop the upload
+        log.warning("Could not write Smartabase cache %s: %s", path, exc)
+
+
+def get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id, force_refresh=False):
     """
     Uses /usersynchronise to retrieve all accessible users.
+    The map is cached in-process and on disk for USER_MAP_CACHE_TTL seconds; force_refresh=True skips both caches.
 
     Returns:
         dict[(first_name, last_name)] -> user_id
     """
+    return _get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id, force_refresh)[0]
+
+
+def _get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id, force_refresh=False):
+    ''' get_usss_user_map, also returning whether the map came from a cache (True) or was just fetched (False) '''
+    key = (sb_url, sb_app_id, sb_username)
+    path = _cache_path("user_map", *key)
+
+    with _USER_MAP_LOCK:
+        if not force_refresh:
+            cached = _USER_MAP_CACHE.get(key)
+            if cached is not None and time.monotonic() - cached[0] <= USER_MAP_CACHE_TTL:
+                return cached[1], True
+
+            user_map = _user_map_from_cache(_read_cache(path, USER_MAP_CACHE_TTL))
+            if user_map is not None:
+                _USER_MAP_CACHE[key] = (time.monotonic(), user_map)
+                return user_map, True
+
+        user_map = _fetch_usss_user_map(sb_username, sb_password, sb_url, sb_app_id)
+        _USER_MAP_CACHE[key] = (time.monotonic(), user_map)
+        # JSON has no tuple keys, so the map is stored as [[first, last], user_id] pairs
+        _write_cache(path, list(user_map.items()))
+        return user_map, False
+
+
+def _user_map_from_cache(pairs):
+    ''' rebuild the (first, last) -> user_id map from its cached pairs, None if the cache is missing or malformed '''
+    try:
+        return {(first, last): user_id for (first, last), user_id in pairs}
+    except (TypeError, ValueError):
+        return None
+
+
+def _fetch_usss_user_map(sb_username, sb_password, sb_url, sb_app_id):
+    """
+    Paginates /usersynchronise and builds the (first_name, last_name) -> user_id map.
+    """
     url = f"{sb_url}/api/v1/usersynchronise?informat=json&format=json"
 
     payload = {
@@ -224,17 +533,20 @@ def get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id):
     }
 
     user_map = {}
+    body = orjson.dumps(payload)
+    cursor = None
+    # headers/auth live on the session, built once per account
+    session = _sb_session(sb_username, sb_password, sb_app_id)
 
     while True:
         r = _post_with_retries(
+            session,
             url,
-            headers=_sb_headers(sb_app_id),
-            auth=_sb_auth(sb_username, sb_password),
-            payload=payload,
+            payload=_with_cursor(body, cursor),
             timeout=60,
             max_attempts=3
         )
-        data = r.json()
+        data = decode_json(r)
 
         users = data.get("users", [])
         for u in users:
@@ -245,8 +557,6 @@ def get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id):
         if not cursor:
             break
 
-        payload["cursor"] = cursor
-
     return user_map
 
 # =========================
@@ -254,102 +564,184 @@ def get_usss_user_map(sb_username, sb_password, sb_url, sb_app_id):
 # =========================
 
 
-def _fetch_existing_measurement_ids_for_user_batch(user_ids, form_name, sb_username, sb_password, sb_app_id, sb_url):
+def _fetch_existing_measurement_ids_for_user_batch(user_ids, form_name, sb_username, sb_password, sb_app_id, sb_url, since=0,
+                                                   record_server_errors=True, retry_server_errors=True):
     """
-    Syncs events for a subset of users and returns discovered event IDs.
+    Syncs events for a subset of users and returns (discovered event IDs, server sync time).
+    Only events synced after `since` (a lastSynchronisationTimeOnServer value, 0 = everything) are returned.
+    The server sync time is None if Smartabase didn't report one.
     """
     url = f"{sb_url}/api/v1/synchronise?informat=json&format=json"
     payload = {
         "formName": form_name,
-        "lastSynchronisationTimeOnServer": 0,
+        "lastSynchronisationTimeOnServer": since,
         "userIds": user_ids,
         "paginate": True
     }
 
     existing_ids = set()
+    server_time = None
+    body = orjson.dumps(payload)
+    cursor = None
+    # headers/auth live on the session, built once per account
+    session = _sb_session(sb_username, sb_password, sb_app_id)
 
     while True:
         r = _post_with_retries(
+            session,
             url,
-            headers=_sb_headers(sb_app_id),
-            auth=_sb_auth(sb_username, sb_password),
-            payload=payload,
+            payload=_with_cursor(body, cursor),
             timeout=60,
-            max_attempts=3
+            max_attempts=3,
+            record_server_errors=record_server_errors,
+            retry_server_errors=retry_server_errors
+        )
+        data = decode_json(r)
+
+        # only the "ID" values are kept, the rest of the page is dropped before the next one is fetched
+        existing_ids.update(
+            pair.get("value")
+            for event in data.get("export", {}).get("events", [])
+            for row in event.get("rows", [])
+            for pair in row.get("pairs", [])
+            if pair.get("key") == "ID"
         )
-        data = r.json()
 
-        events = data.get("export", {}).get("events", [])
-        for event in events:
-            for row in event.get("rows", []):
-                for pair in row.get("pairs", []):
-                    if pair.get("key") == "ID":
-                        existing_ids.add(pair.get("value"))
+        page_time = data.get("lastSynchronisationTimeOnServer")
+        if page_time is not None:
+            server_time = page_time if server_time is None else max(server_time, page_time)
 
         cursor = data.get("export", {}).get("nextCursor")
         if not cursor:
             break
 
-        payload["cursor"] = cursor
+    return existing_ids, server_time
 
-    return existing_ids
-def get_existing_measurement_ids(user_ids, form_name, sb_username, sb_password, sb_app_id, sb_url):
+
+def _sync_state_from_cache(state):
+    ''' rebuild the dedupe state (ids set, user_id -> watermark dict, created time) from its cached JSON,
+        None if the cache is missing or malformed '''
+    try:
+        return {
+            "ids": set(state["ids"]),
+            "watermarks": {int(user_id): since for user_id, since in state["watermarks"]},
+            "created": float(state["created"])
+        }
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def get_existing_measurement_ids(user_ids, form_name, sb_username, sb_password, sb_app_id, sb_url, pending_ids_by_user=None):
     """
     Pulls existing form events
     and returns a set of measurement IDs already uploaded.
+    IDs from earlier runs are kept on disk with a per-user lastSynchronisationTimeOnServer watermark,
+    so each run only asks Smartabase for events synced since that user's last successful sync.
+    The stored state is thrown away after SYNC_STATE_TTL seconds, forcing a full resync.
+    If pending_ids_by_user (user_id -> IDs about to be uploaded) is given, users whose pending IDs
+    are all already known are not synced at all.
     """
-    if not user_ids:
+    if len(user_ids) == 0:
         return set()
 
-    unique_user_ids = []
-    for user_id in user_ids:
-        if pd.notna(user_id):
-            unique_user_ids.append(int(user_id))
-    unique_user_ids = list(dict.fromkeys(unique_user_ids))
+    # sorted so the same set of users always produces the same batches and request bodies
+    unique_user_ids = pd.Series(user_ids).dropna().astype("int64").drop_duplicates().sort_values().tolist()
+
+    state_path = _cache_path("sync_state", sb_url, sb_app_id, sb_username, form_name)
+    state = _sync_state_from_cache(_read_cache(state_path, float("inf")))
+    # a periodic full resync drops IDs of events that were deleted in Smartabase since
+    if state is None or time.time() - state["created"] > SYNC_STATE_TTL:
+        state = {"ids": set(), "watermarks": {}, "created": time.time()}
+    watermarks = state["watermarks"]
+    existing_ids = state["ids"]
+    user_batch_size = 100 # halved on 5xx, see fetch_batch
+
+    # a sync can only ever add IDs, so it can't change the answer for users with nothing unknown to upload
+    if pending_ids_by_user is not None:
+        unique_user_ids = [
+            user_id for user_id in unique_user_ids
+            if not pending_ids_by_user.get(user_id, set()) <= existing_ids
+        ]
 
-    existing_ids = set()
-    user_batch_size = 25
+    def sync(batch):
+        # every user in a batch shares a watermark, users never synced before start from 0
+        since = watermarks.get(batch[0], 0)
+        # a multi-user batch that 5xxs is split in half rather than retried at the same size
+        # (network errors, timeouts and 429 are still retried as is),
+        # and that 5xx is a size problem, not an outage, so it stays off the circuit breaker.
+        # single-user syncs still count, which is enough for an outage to trip the breaker
+        split = len(batch) > 1
+        ids, server_time = _fetch_existing_measurement_ids_for_user_batch(
+            batch,
+            form_name,
+            sb_username,
+            sb_password,
+            sb_app_id,
+            sb_url,
+            since=since,
+            record_server_errors=not split,
+            retry_server_errors=not split
+        )
+        return batch, ids, server_time
 
-    for batch in _chunk_list(unique_user_ids, user_batch_size):
+    def fetch_batch(batch, fallback=False):
+        ''' returns (synced results, halves still to sync) '''
+        # cursors are scoped to a single synchronise request, so each batch paginates on its own thread
         try:
-            existing_ids.update(
-                _fetch_existing_measurement_ids_for_user_batch(
-                    batch,
-                    form_name,
-                    sb_username,
-                    sb_password,
-                    sb_app_id,
-                    sb_url
-                )
-            )
+            return [sync(batch)], []
         except requests.HTTPError as exc:
             status = exc.response.status_code if exc.response is not None else None
 
-            # Fallback for intermittent/size-related server failures.
+            # Fallback for intermittent/size-related server failures: halve the batch until the server copes.
+            # the halves are handed back rather than synced here, so every split shares the one bounded fallback pool
             if status is not None and status >= 500 and len(batch) > 1:
-                print(
-                    f"WARNING: Smartabase sync returned {status} for a user batch of "
-                    f"{len(batch)}. Retrying one user at a time."
-                )
-                for user_id in batch:
-                    try:
-                        existing_ids.update(
-                            _fetch_existing_measurement_ids_for_user_batch(
-                                [user_id],
-                                form_name,
-                                sb_username,
-                                sb_password,
-                                sb_app_id,
-                                sb_url
-                            )
-                        )
-                    except requests.RequestException as single_exc:
-                        print(f"WARNING: Could not dedupe existing events for user_id={user_id}: {single_exc}")
-                continue
+                log.warning("Smartabase sync returned %s for a user batch of %d. Retrying in halves.", status, len(batch))
+                half = len(batch) // 2
+                return [], [batch[:half], batch[half:]]
 
+            if not fallback:
+                raise
+            log.warning("Could not dedupe existing events for user_ids=%s: %s", batch, exc)
+            return [], []
+        except CircuitOpenError:
+            # Smartabase is down: uploading against a partial dedupe set would duplicate every event, so abort
             raise
         except requests.RequestException as exc:
             # Keep the upload running even if dedup fetch fails unexpectedly.
-            print(f"WARNING: Could not fetch existing event IDs for a user batch: {exc}")
+            log.warning("Could not fetch existing event IDs for a user batch: %s", exc)
+            return [], []
+
+    # batches never mix watermarks, so a new or stale user doesn't force a full sync on the rest
+    by_watermark = {}
+    for user_id in unique_user_ids:
+        by_watermark.setdefault(watermarks.get(user_id, 0), []).append(user_id)
+    batches = [batch for group in by_watermark.values() for batch in _chunk_list(group, user_batch_size)]
+
+    synced = False
+    # at most SYNC_MAX_WORKERS + SYNC_FALLBACK_MAX_WORKERS syncs are in flight, however deep the splitting goes
+    with ThreadPoolExecutor(max_workers=SYNC_MAX_WORKERS) as executor, \
+            ThreadPoolExecutor(max_workers=SYNC_FALLBACK_MAX_WORKERS) as fallback_executor:
+        pending = {executor.submit(fetch_batch, batch) for batch in batches}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results, halves = future.result()
+                    pending.update(fallback_executor.submit(fetch_batch, half, True) for half in halves)
+                    for batch, ids, server_time in results:
+                        existing_ids.update(ids)
+                        # failed users keep their old watermark, so their missed events are picked up next run
+                        if server_time is not None:
+                            watermarks.update(dict.fromkeys(batch, server_time))
+                        synced = True
+        except BaseException:
+            # the dedupe is being aborted, don't start the batches that haven't run yet
+            for future in pending:
+                future.cancel()
+            raise
+
+    if synced:
+        # ids as a list and watermarks as [user_id, time] pairs, since JSON has no sets or int keys
+        _write_cache(state_path, {"ids": list(existing_ids), "watermarks": list(watermarks.items()), "created": state["created"]})
 
     return existing_ids